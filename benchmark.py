@@ -0,0 +1,491 @@
+# Benchmark suite for the playground modules
+#
+# Generates synthetic input files at a controllable scale, times every
+# public entry point across sizes, records throughput and peak memory
+# and compares the results against a stored baseline.
+#
+# Usage:
+#   python benchmark.py                      run and print the results
+#   python benchmark.py --save-baseline      run and store the baseline
+#   python benchmark.py --sizes 100 400      choose the scales
+#   python benchmark.py --only graph         run the cases matching a name
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import timeit
+import tracemalloc
+from datetime import date
+
+import dataAnalysis
+import dataMining
+import graphAlgorithm
+import main
+
+BASELINE_FILE = 'benchmark_baseline.json'
+DEFAULT_SIZES = [100, 400]
+# Differences below these are timer and allocator noise, not regressions
+NOISE_FLOOR_SECONDS = 50e-6
+NOISE_FLOOR_BYTES = 4096
+
+# Synthetic data generators
+
+def write_graph_file(filename, position_list, link_list):
+    '''Write a graph in the read_graph_from_file format: one line
+    "node,x,y" per node, in order, then one line "a,b" per link.'''
+    with open(filename, 'w') as out:
+        for node, (x, y) in enumerate(position_list):
+            out.write('{},{},{}\n'.format(node, x, y))
+        for (a, b) in link_list:
+            out.write('{},{}\n'.format(a, b))
+
+def make_chain_graph(n):
+    '''A single path 0-1-2-...-(n-1).'''
+    position_list = [(node*10, 0) for node in range(n)]
+    link_list = [(node, node + 1) for node in range(n - 1)]
+    return (position_list, link_list)
+
+def make_grid_graph(n):
+    '''A square grid with about n nodes, each linked to its right and
+    bottom neighbours.'''
+    side = max(1, int(n ** 0.5))
+    position_list = [(col*10, row*10) for row in range(side) for col in range(side)]
+    link_list = []
+    for row in range(side):
+        for col in range(side):
+            node = row*side + col
+            if col + 1 < side:
+                link_list.append((node, node + 1))
+            if row + 1 < side:
+                link_list.append((node, node + side))
+    return (position_list, link_list)
+
+def make_random_graph(n, degree=3, seed=0):
+    '''n nodes at random positions with about n*degree/2 random links.'''
+    rng = random.Random(seed)
+    position_list = [(rng.randint(0, 1000), rng.randint(0, 1000)) for node in range(n)]
+    link_list = set()
+    while len(link_list) < min(n*degree//2, n*(n - 1)//2):
+        a = rng.randrange(n)
+        b = rng.randrange(n)
+        if a != b and (b, a) not in link_list:
+            link_list.add((a, b))
+    return (position_list, sorted(link_list))
+
+def make_components_graph(n, component_size=5, seed=0):
+    '''Many small components: chains of component_size nodes, some of
+    them closed into a cycle.'''
+    rng = random.Random(seed)
+    position_list = [(rng.randint(0, 1000), rng.randint(0, 1000)) for node in range(n)]
+    link_list = []
+    for first in range(0, n, component_size):
+        last = min(first + component_size, n) - 1
+        for node in range(first, last):
+            link_list.append((node, node + 1))
+        if last - first > 1 and rng.random() < 0.5:
+            link_list.append((last, first))
+    return (position_list, link_list)
+
+GRAPH_SHAPES = {
+    'chain': make_chain_graph,
+    'grid': make_grid_graph,
+    'random': make_random_graph,
+    'components': make_components_graph,
+}
+
+def write_knn_files(train_name, test_name, n_train, n_test, features=4,
+                    classes=3, seed=0):
+    '''Write a train and a test file in the process_file format: a header
+    line, then one record per line with the features followed by an
+    integer class. Every class is a gaussian blob around its own centre.'''
+    rng = random.Random(seed)
+    centres = [[rng.uniform(1, 10) for f in range(features)] for c in range(classes)]
+    header = ','.join(['f' + str(f) for f in range(features)] + ['class'])
+    for (filename, count) in ((train_name, n_train), (test_name, n_test)):
+        with open(filename, 'w') as out:
+            out.write(header + '\n')
+            for record in range(count):
+                label = rng.randrange(classes)
+                values = ['{:.4f}'.format(rng.gauss(centre, 1.0))
+                          for centre in centres[label]]
+                out.write(','.join(values + [str(label)]) + '\n')
+
+def write_station_file(filename, n_days, start_year=1960, noise=0.05, seed=0):
+    '''Write a station temperature file in the layout used by
+    accept_entry: product code, station, year, month, day, maximum
+    temperature, days of accumulation, quality. A fraction noise of the
+    rows are blank, unrealistic or flagged 'N' to exercise the filter.'''
+    rng = random.Random(seed)
+    with open(filename, 'w') as out:
+        out.write('Product code,Station number,Year,Month,Day,'
+                  'Maximum temperature (Degree C),'
+                  'Days of accumulation of maximum temperature,Quality\n')
+        first_day = date(start_year, 1, 1).toordinal()
+        for day in range(n_days):
+            today = date.fromordinal(first_day + day)
+            temp = '{:.1f}'.format(rng.gauss(25, 8))
+            quality = 'Y'
+            if rng.random() < noise:
+                (temp, quality) = rng.choice([('', 'Y'), ('99.9', 'Y'), (temp, 'N')])
+            out.write('IDCJAC0010,86282,{},{:02d},{:02d},{},1,{}\n'.format(
+                today.year, today.month, today.day, temp, quality))
+
+# Benchmark cases
+#
+# Every case is a function taking the size and a working directory; it
+# prepares its input and returns (function, items), where function is
+# the call to time and items the number of elements it processes, used
+# for the throughput.
+
+CASES = []
+
+def benchmark(name):
+    def register(setup):
+        CASES.append((name, setup))
+        return setup
+    return register
+
+def _graph_cases(shape):
+    def prepared_graph(size, workdir):
+        filename = os.path.join(workdir, '{}-{}.csv'.format(shape, size))
+        if not os.path.exists(filename):
+            write_graph_file(filename, *GRAPH_SHAPES[shape](size))
+        return filename
+
+    @benchmark('graph.read_graph_from_file.' + shape)
+    def read_case(size, workdir):
+        filename = prepared_graph(size, workdir)
+        return (lambda: graphAlgorithm.read_graph_from_file(filename), size)
+
+    @benchmark('graph.read_graph_from_file_parallel.' + shape)
+    def read_parallel_case(size, workdir):
+        filename = prepared_graph(size, workdir)
+        # Chunks small enough that even the small sizes are split, and at
+        # least two workers, so that the process pool path is timed
+        chunk_bytes = max(256, os.path.getsize(filename) // 4)
+        return (lambda: graphAlgorithm.read_graph_from_file_parallel(
+            filename, workers=2, chunk_bytes=chunk_bytes), size)
+
+    @benchmark('graph.label_graph_components.' + shape)
+    def label_case(size, workdir):
+        (neighbour_list, position_list) = \
+            graphAlgorithm.read_graph_from_file(prepared_graph(size, workdir))
+        return (lambda: graphAlgorithm.label_graph_components(neighbour_list), size)
+
+    @benchmark('graph.component_stats.' + shape)
+    def stats_case(size, workdir):
+        (neighbour_list, position_list) = \
+            graphAlgorithm.read_graph_from_file(prepared_graph(size, workdir))
+        label_list = graphAlgorithm.label_graph_components(neighbour_list)
+        def run():
+            for label in range(max(label_list) + 1):
+                graphAlgorithm.get_component_density(label, neighbour_list, label_list)
+                graphAlgorithm.component_is_a_tree(label, neighbour_list, label_list)
+        return (run, size)
+
+    @benchmark('graph.bfs_shortest_paths.' + shape)
+    def bfs_case(size, workdir):
+        (neighbour_list, position_list) = \
+            graphAlgorithm.read_graph_from_file(prepared_graph(size, workdir))
+        return (lambda: graphAlgorithm.bfs_shortest_paths(0, neighbour_list), size)
+
+    @benchmark('graph.dijkstra_shortest_paths.' + shape)
+    def dijkstra_case(size, workdir):
+        (neighbour_list, position_list) = \
+            graphAlgorithm.read_graph_from_file(prepared_graph(size, workdir))
+        return (lambda: graphAlgorithm.dijkstra_shortest_paths(
+            0, neighbour_list, position_list), size)
+
+    @benchmark('graph.ShortestPathCache.' + shape)
+    def cache_case(size, workdir):
+        (neighbour_list, position_list) = \
+            graphAlgorithm.read_graph_from_file(prepared_graph(size, workdir))
+        rng = random.Random(0)
+        nodes = len(neighbour_list)
+        queries = [(rng.randrange(min(8, nodes)), rng.randrange(nodes)) for q in range(size)]
+        def run():
+            cache = graphAlgorithm.ShortestPathCache(neighbour_list, position_list)
+            for (source, target) in queries:
+                cache.distance(source, target)
+        return (run, len(queries))
+
+    @benchmark('main.analyse_graph_file.' + shape)
+    def analyse_case(size, workdir):
+        filename = prepared_graph(size, workdir)
+        def run():
+            # analyse_graph_file reports errors in its result instead of
+            # raising, a failed file must not be timed as a fast run
+            result = main.analyse_graph_file(filename)
+            if result['error'] is not None:
+                raise RuntimeError(result['error'])
+        return (run, size)
+
+for shape in GRAPH_SHAPES:
+    _graph_cases(shape)
+
+def _knn_files(size, workdir):
+    train_name = os.path.join(workdir, 'knn-train-{}.csv'.format(size))
+    test_name = os.path.join(workdir, 'knn-test-{}.csv'.format(size))
+    if not os.path.exists(train_name):
+        write_knn_files(train_name, test_name, size, max(1, size // 10))
+    return (train_name, test_name)
+
+@benchmark('mining.process_file')
+def process_file_case(size, workdir):
+    (train_name, test_name) = _knn_files(size, workdir)
+    # one distance per metric for every train/test pair
+    return (lambda: dataMining.process_file(train_name, test_name),
+            size * max(1, size // 10))
+
+@benchmark('mining.evaluate')
+def evaluate_case(size, workdir):
+    (train_name, test_name) = _knn_files(size, workdir)
+    return (lambda: dataMining.evaluate(train_name, test_name),
+            size * max(1, size // 10))
+
+@benchmark('mining.LSHIndex')
+def lsh_case(size, workdir):
+    (train_name, test_name) = _knn_files(size, workdir)
+    (train, train_labels) = dataMining.load_records(train_name)
+    (queries, query_labels) = dataMining.load_records(test_name)
+    def run():
+        for metric in ('Euclidean', 'Cosine'):
+            index = dataMining.LSHIndex(train, train_labels, metric)
+            for query in queries:
+                index.query(query, 9)
+    return (run, 2 * len(queries))
+
+@benchmark('mining.distances')
+def distances_case(size, workdir):
+    rng = random.Random(0)
+    pairs = [([str(rng.random()) for f in range(5)], [str(rng.random()) for f in range(5)])
+             for p in range(size)]
+    def run():
+        for (a, b) in pairs:
+            dataMining.euclidean(a, b)
+            dataMining.manhattan(a, b)
+            dataMining.cosine(a, b)
+    return (run, size)
+
+@benchmark('mining.knn')
+def knn_case(size, workdir):
+    rng = random.Random(0)
+    mapped = sorted((rng.random(), rng.randrange(3)) for p in range(size))
+    def run():
+        for k in (1, 3, 5, 9):
+            dataMining.knn(mapped, 0, k)
+    return (run, 4)
+
+def _station_file(size, workdir):
+    '''Ten days per unit of size, so that even the smallest sizes span
+    the several years process_data_file needs for its two halves.'''
+    filename = os.path.join(workdir, 'station-{}.csv'.format(size))
+    if not os.path.exists(filename):
+        write_station_file(filename, size*10)
+    return filename
+
+@benchmark('analysis.process_data_file')
+def process_data_file_case(size, workdir):
+    filename = _station_file(size, workdir)
+    return (lambda: dataAnalysis.process_data_file(filename), size*10)
+
+@benchmark('analysis.RollingAnalytics')
+def rolling_case(size, workdir):
+    filename = _station_file(size, workdir)
+    def run():
+        analytics = dataAnalysis.RollingAnalytics(30)
+        analytics.update_from_file(filename)
+    return (run, size*10)
+
+@benchmark('analysis.accept_entry')
+def accept_entry_case(size, workdir):
+    with open(_station_file(size, workdir)) as csvfile:
+        csvfile.readline()
+        entries = [entry[:-1] for entry in csvfile]
+    def run():
+        for entry in entries:
+            dataAnalysis.accept_entry(entry)
+    return (run, len(entries))
+
+# Measurement
+
+def measure(function, repeat):
+    '''Return (best time in seconds per call, peak traced memory in bytes)
+    of function. Every timed run loops the function as many times as
+    timeit.Timer.autorange needs to last at least 0.2 seconds, so that
+    fast cases are above the timer resolution; the best of repeat runs is
+    kept. Timing and memory tracing are done in separate runs so the
+    tracing overhead does not affect the time. Output is discarded.'''
+    timer = timeit.Timer(function)
+    with contextlib.redirect_stdout(io.StringIO()):
+        (number, total) = timer.autorange()
+        best = total / number
+        if repeat > 1:
+            best = min([best] + [run / number for run in timer.repeat(repeat - 1, number)])
+        tracemalloc.start()
+        try:
+            function()
+            (current, peak) = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    return (best, peak)
+
+def _calibration_work():
+    # Fixed pure Python work (loops, lists, dicts, sorting), whose time
+    # tells how fast the machine is running right now
+    counts = {}
+    values = []
+    for i in range(2000):
+        value = (i * 7919) % 1009
+        counts[value % 17] = counts.get(value % 17, 0) + 1
+        values.append((value, i))
+    values.sort()
+    return counts
+
+def calibrate():
+    '''Return the best time in seconds of the calibration work. Every
+    case stores it next to its own time, and compare looks at the ratio,
+    so that a machine running slower or faster (shared CPU, frequency
+    scaling) is not taken for a change in the code.'''
+    timer = timeit.Timer(_calibration_work)
+    (number, total) = timer.autorange()
+    return min([total] + timer.repeat(2, number)) / number
+
+def run_benchmarks(sizes, repeat=3, only=None, workdir=None, keys=None):
+    '''Run every registered case (whose name contains only, if given) at
+    every size, or only the given "name[size]" keys. Returns a dictionary
+    "name[size]" -> result.'''
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        workdir = workdir or tmpdir
+        for (name, setup) in CASES:
+            if only and only not in name:
+                continue
+            for size in sizes:
+                key = '{}[{}]'.format(name, size)
+                if keys is not None and key not in keys:
+                    continue
+                try:
+                    (function, items) = setup(size, workdir)
+                    calibration = calibrate()
+                    (seconds, peak) = measure(function, repeat)
+                    calibration = min(calibration, calibrate())
+                except Exception as exc:
+                    results[key] = {'error': type(exc).__name__ + ': ' + str(exc)}
+                else:
+                    results[key] = {'seconds': seconds, 'items': items,
+                                    'throughput': items / seconds if seconds else None,
+                                    'peak_bytes': peak, 'calibration': calibration}
+                print_result(key, results[key])
+    return results
+
+def compare(results, baseline, tolerance, noise_seconds=NOISE_FLOOR_SECONDS,
+            noise_bytes=NOISE_FLOOR_BYTES):
+    '''Return two lists of (key, reason): the regressions, cases that fail
+    or got slower or use more memory than the baseline by more than
+    tolerance (a fraction) and by more than the noise floor (absolute
+    seconds per call or bytes); and the cases that failed in the baseline
+    and pass now.'''
+    regressions = []
+    fixed = []
+    for (key, result) in results.items():
+        old = baseline.get(key)
+        if old is None:
+            continue
+        if 'error' in old:
+            if 'error' in result:
+                regressions.append((key, 'still fails: ' + result['error']))
+            else:
+                fixed.append((key, 'now passes, failed in the baseline: ' + old['error']))
+            continue
+        if 'error' in result:
+            regressions.append((key, 'now fails: ' + result['error']))
+            continue
+        # The baseline time as it would be at the current machine speed;
+        # the calibration is noisy too, so it only excuses a slower
+        # machine and never makes the baseline stricter
+        old_seconds = old['seconds']
+        if 'calibration' in old and 'calibration' in result:
+            old_seconds *= max(1.0, result['calibration'] / old['calibration'])
+        if result['seconds'] > old_seconds * (1 + tolerance) and \
+           result['seconds'] - old_seconds > noise_seconds:
+            regressions.append((key, 'time {:.3g}s -> {:.3g}s (baseline {:.3g}s '
+                                'at the current machine speed)'.format(
+                old['seconds'], result['seconds'], old_seconds)))
+        if result['peak_bytes'] > old['peak_bytes'] * (1 + tolerance) and \
+           result['peak_bytes'] - old['peak_bytes'] > noise_bytes:
+            regressions.append((key, 'peak memory {} -> {} bytes'.format(
+                old['peak_bytes'], result['peak_bytes'])))
+    return (regressions, fixed)
+
+def keep_best(results, rerun):
+    '''Replace the results of the cases measured again in rerun by the
+    faster of the two measurements.'''
+    for (key, result) in rerun.items():
+        old = results.get(key)
+        if 'error' in result or old is None or 'error' in old:
+            continue
+        if result['seconds'] < old['seconds']:
+            results[key] = result
+
+def print_result(key, result):
+    if 'error' in result:
+        print('{:<55s} ERROR {}'.format(key, result['error']))
+    else:
+        print('{:<55s} {:>10.3g}s {:>12.4g} items/s {:>10d} peak bytes'.format(
+            key, result['seconds'], result['throughput'] or 0, result['peak_bytes']))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the playground modules.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="timed runs per case, the best is kept")
+    parser.add_argument('--only', help="run only the cases whose name contains this")
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--save-baseline', action='store_true',
+                        help="store the results as the new baseline")
+    parser.add_argument('--noise-floor', type=float, default=NOISE_FLOOR_SECONDS,
+                        help="slowdowns smaller than this (seconds per call) are ignored")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="allowed slowdown before flagging a regression")
+    parser.add_argument('--retries', type=int, default=2,
+                        help="times a slower case is measured again before "
+                             "it is reported as a regression")
+    parser.add_argument('--workdir',
+                        help="keep the generated input files in this directory")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.sizes, args.repeat, args.only, args.workdir)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as out:
+            json.dump(results, out, indent=2, sort_keys=True)
+        print('\nBaseline saved to ' + args.baseline)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        (regressions, fixed) = compare(results, baseline, args.tolerance, args.noise_floor)
+        # A slowdown on a shared or throttled machine is often transient:
+        # measure the slower cases again and report only what persists
+        for retry in range(args.retries):
+            slower = set(key for (key, reason) in regressions if reason.startswith('time'))
+            if not slower:
+                break
+            print('\nMeasuring again: ' + ', '.join(sorted(slower)))
+            keep_best(results, run_benchmarks(args.sizes, args.repeat, args.only,
+                                              args.workdir, keys=slower))
+            (regressions, fixed) = compare(results, baseline, args.tolerance,
+                                           args.noise_floor)
+        print()
+        for (key, reason) in fixed:
+            print('FIXED {}: {}'.format(key, reason))
+        for (key, reason) in regressions:
+            print('REGRESSION {}: {}'.format(key, reason))
+        if regressions:
+            sys.exit(1)
+        print('No regressions against ' + args.baseline)
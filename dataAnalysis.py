@@ -2,23 +2,60 @@
 # Vittorio Beltracchi (C) 2014
 # Obtain data from CSV files, analyse, and provide results
 
-def process_data_file (filename):
-    flag = False
-    tot_list = []
-    sum_temp = 0
-    tot_hot_days = 0
-    years_list = []
+from array import array
+from calendar import month_abbr
+from datetime import date
 
-    while not flag:
-        try:
-            csvfile = open(filename, "rU")
-            flag = True
-        except IOError:
-            print('\n--- ',filename,' FILE NOT FOUND!\n')
-            filename = input('Enter a file name: ')
+class RecordStore:
+    # Compact storage of the valid records: years as unsigned shorts and
+    # temperatures as doubles in typed arrays, about 10 bytes per record.
+    # Every run of consecutive rows with the same year is indexed as
+    # [year, first row, end row], so the rows of a year are slices instead
+    # of a scan. Records are expected in date order, a year found again
+    # after another one (a gap or unsorted rows) gets one more run.
 
-    header = csvfile.readline()
+    def __init__(self):
+        self.years = array('H')
+        self.temps = array('d')
+        self.runs = []
+        # Year -> positions in runs of all its runs
+        self.year_rows = {}
+
+    def __len__(self):
+        return len(self.temps)
+
+    def append(self, year, temperature):
+        if self.runs and self.runs[-1][0] == year:
+            self.runs[-1][2] += 1
+        else:
+            self.year_rows.setdefault(year, []).append(len(self.runs))
+            self.runs.append([year, len(self.temps), len(self.temps) + 1])
+        self.years.append(year)
+        self.temps.append(temperature)
+
+    def year_ranges(self, year):
+        # [(first row, end row)] of every run of the year, KeyError if
+        # there is no data
+        return [tuple(self.runs[run][1:]) for run in self.year_rows[year]]
+
+    def year_range(self, year):
+        # (first row, end row) of the year, KeyError if there is no data
+        # and ValueError if its rows are not contiguous
+        ranges = self.year_ranges(year)
+        if len(ranges) > 1:
+            raise ValueError('rows of year {} are not contiguous, '
+                             'use year_ranges'.format(year))
+        return ranges[0]
+
+    def year_temperatures(self, year):
+        temps = array('d')
+        for (first, end) in self.year_ranges(year):
+            temps.extend(self.temps[first:end])
+        return temps
 
+def load_record_store(csvfile):
+    # Read the valid entries of an open data file, header already skipped
+    store = RecordStore()
     for entry in csvfile:
 
         entry_without_newline = entry[:-1]
@@ -27,115 +64,83 @@ def process_data_file (filename):
         if accept_entry(entry_without_newline):
             continue
 
-        # Calculate the average and number of "very hot" days
         record = entry_without_newline.split(',')
+        store.append(int(record[2]), float(record[5]))
 
-        temp_tuple = (record[2],float(record[5]))
+    return store
 
-        tot_list.append(temp_tuple)
+def process_data_file (filename):
+    flag = False
 
-    csvfile.close()
-    
-    # Year average and number of 37+ days per each year
-    year = tot_list[0][0]
+    while not flag:
+        try:
+            csvfile = open(filename, "r")
+            flag = True
+        except IOError:
+            print('\n--- ',filename,' FILE NOT FOUND!\n')
+            filename = input('Enter a file name: ')
 
-    years_list.append(temp_tuple[0])
+    header = csvfile.readline()
 
-    year_temp_list = []
-    year_hot_days = 0
+    store = load_record_store(csvfile)
 
-    for temp_tuple in tot_list:
-        # Control on the year field, if same year append to the year list
-        if temp_tuple[0] == year:
-            year_temp_list.append(temp_tuple[1])
-        else:
-            print()
-            # Calculate the average and display it at the same time
-            print('{:<5s}: average = {}'.format(year,sum(year_temp_list) / len(year_temp_list)))
-            # Loop through the list looking for the 37+ days for that year
-            for temperature in year_temp_list:
-                if temperature > 37:
-                    year_hot_days += 1
-            print('{:<7s}number of 37+ days = {}'.format('',year_hot_days))
-            # Reset all the value, ready for the following year
-            year = temp_tuple[0]
-            year_hot_days = 0
-            year_temp_list[:] = []
-            year_temp_list.append(temp_tuple[1])
-
-            years_list.append(temp_tuple[0])
-
-    # The latest print must be outside the loop if not is avoided
-    print()
-    print('{:<5s}: average = {}'.format(year,sum(year_temp_list) / len(year_temp_list)))
-    for temperature in year_temp_list:
-        if temperature > 37:
-            year_hot_days += 1
-    print('{:<7s}number of 37+ days = {}'.format('',year_hot_days))
-    # Calculate total average over the file
-    for temp_tuple in tot_list:
-        sum_temp += temp_tuple[1]
+    csvfile.close()
+
+    # Year average and number of 37+ days per each year, every year is
+    # a slice of the temperatures
+    for (year, first, end) in store.runs:
+        year_temps = store.temps[first:end]
+        year_hot_days = 0
+        for temperature in year_temps:
+            if temperature > 37:
+                year_hot_days += 1
+        print()
+        print('{:<5s}: average = {}'.format(str(year),sum(year_temps) / len(year_temps)))
+        print('{:<7s}number of 37+ days = {}'.format('',year_hot_days))
 
-        if temp_tuple[1] > 37 :
+    # Calculate total average over the file
+    tot_hot_days = 0
+    for temperature in store.temps:
+        if temperature > 37 :
             tot_hot_days += 1
 
-    print('\naverage =',sum_temp/ len(tot_list))
+    print('\naverage =',sum(store.temps)/ len(store.temps))
     print('number of 37+ days =',tot_hot_days)
     # Empty line to give some format
     print()
 
     # Split the time period in two not even halves, because of the quantity of data can be different.
     # Calculate the average per each half and display the results.
-    # Having the valid data in a list comes handy at this point.
-    # On the other hands, it is not recommended to store data locally, because we cannot be sure about their quantity.
-
-    only_years_list = []
-    only_temps_list = []
-
-    for temp_touple in tot_list:
-        only_years_list.append(temp_touple[0])
-        only_temps_list.append(temp_touple[1])
+    # The year in the middle of the years analysed is the split point,
+    # its first row comes straight from the index of the runs
+    mid_point = store.runs[len(store.runs) // 2][1]
 
-    # Stored before a list of unique years, use the one in the half of it
-    # as referiment for middle point, then I determine at which index
-    # that year is found, the return value is the first index containing the year
-    # in the middle of the whole number of years analysed
-    mid_point = only_years_list.index(years_list[int(len(years_list)/2)])
-
-    # Use this middle point to split the list in other two halves
-    # used to calculate the average per sample
-    first_sample = only_temps_list[:mid_point]
-    first_years = only_years_list[:mid_point]
-    second_sample = only_temps_list[mid_point:]
-    second_years = only_years_list[mid_point:]
+    first_sample = store.temps[:mid_point]
+    second_sample = store.temps[mid_point:]
 
     first_avg = sum(first_sample)/len(first_sample)
     second_avg = sum(second_sample)/len(second_sample)
     # Then display
-    print('average {:<4s}-{:<4s} = {}'.format(first_years[0], \
-                                     first_years[-1], \
+    print('average {:<4s}-{:<4s} = {}'.format(str(store.years[0]), \
+                                     str(store.years[mid_point - 1]), \
                                      first_avg))
-    print('average {:<4s}-{:<4s} = {}'.format(second_years[0], \
-                                     second_years[-1], \
+    print('average {:<4s}-{:<4s} = {}'.format(str(store.years[mid_point]), \
+                                     str(store.years[-1]), \
                                      second_avg))
-    # Empty all the used lists
-    first_sample[:] = []
-    first_years[:] = []
-    second_sample[:] = []
-    second_years[:] = []
-    only_years_list[:] = []
-    only_temps_list[:] = []
-    year_temp_list[:] = []
-    years_list[:] = []
-    tot_list[:] = []
+
+# Fields of a complete entry, the Quality field is the last one
+ENTRY_FIELDS = 8
 
 def accept_entry (entry):    
     # Must ignore noise
     line = entry.split(',')
 
     # Instruct all the conditions that must ignore the data
+    # Blank or truncated line
+    if len(line) < ENTRY_FIELDS:
+        return True
     # Field Year, Month, Day, Temperature or Quality is empty
-    if line[2] =='' or line[3] =='' or line[4] =='' or line[5]=='' or line[7] =='' :
+    elif line[2] =='' or line[3] =='' or line[4] =='' or line[5]=='' or line[7] =='' :
         # print('Found Blank')
         return True
     # The Quality field is 'N'
@@ -149,6 +154,172 @@ def accept_entry (entry):
     else :       
         return False
 
+class RollingAnalytics:
+    # Incremental analytics over daily records: moving average and hot
+    # days in the last window_days days, and per-month climatology.
+    # Every record costs O(1): the window is a ring buffer indexed by
+    # the day, with running sums updated as days enter and leave it.
+
+    def __init__(self, window_days=30, hot_threshold=37):
+        if window_days < 1:
+            raise ValueError('The window must be at least one day!')
+        self.window_days = window_days
+        self.hot_threshold = hot_threshold
+
+        # Ring buffer, None for the days without a valid record
+        self.window = [None]*window_days
+        self.window_sum = 0.0
+        self.window_count = 0
+        self.window_hot = 0
+        self.last_day = None
+
+        # Running sums per calendar month, index 0 is January
+        self.month_sum = [0.0]*12
+        self.month_count = [0]*12
+        self.month_hot = [0]*12
+
+        # Where to continue reading each file in update_from_file
+        self.file_positions = {}
+
+    def add_entry(self, entry):
+        # Same filtering rules as process_data_file, returns False if the
+        # entry is noise and has been ignored
+        if accept_entry(entry):
+            return False
+        record = entry.split(',')
+        self.add(int(record[2]), int(record[3]), int(record[4]), float(record[5]))
+        return True
+
+    def add(self, year, month, day, temperature):
+        today = date(year, month, day).toordinal()
+        if self.last_day is not None and today <= self.last_day:
+            raise ValueError('Entries are not in date order: {}-{:02d}-{:02d}'.format(year, month, day))
+
+        # Empty the slots of the days leaving the window, at most the
+        # whole window when the gap is longer than it
+        if self.last_day is not None and today - self.last_day >= self.window_days:
+            for slot in range(self.window_days):
+                self._remove(slot)
+        elif self.last_day is not None:
+            for old_day in range(self.last_day + 1, today + 1):
+                self._remove(old_day % self.window_days)
+
+        self.window[today % self.window_days] = temperature
+        self.window_sum += temperature
+        self.window_count += 1
+        if temperature > self.hot_threshold:
+            self.window_hot += 1
+        self.last_day = today
+
+        self.month_sum[month - 1] += temperature
+        self.month_count[month - 1] += 1
+        if temperature > self.hot_threshold:
+            self.month_hot[month - 1] += 1
+
+    def _remove(self, slot):
+        temperature = self.window[slot]
+        if temperature is not None:
+            self.window_sum -= temperature
+            self.window_count -= 1
+            if temperature > self.hot_threshold:
+                self.window_hot -= 1
+            self.window[slot] = None
+
+    def moving_average(self):
+        # Average of the valid records in the window, None if there are none
+        if self.window_count == 0:
+            return None
+        return self.window_sum / self.window_count
+
+    def hot_days(self):
+        # Number of days above the threshold in the window
+        return self.window_hot
+
+    def climatology(self):
+        # List of (average, hot days) per calendar month, average is None
+        # for the months without data
+        return [(self.month_sum[m] / self.month_count[m] if self.month_count[m] else None,
+                 self.month_hot[m]) for m in range(12)]
+
+    def update_from_file(self, filename):
+        # Read the entries added to the file since the last call, the
+        # first call also skips the header. Returns the number of accepted
+        # entries and the list of (entry, reason) of the rejected ones:
+        # blank or truncated lines, invalid values and dates not after the
+        # previous entry are skipped, so that a bad row cannot stop the
+        # following ones from arriving.
+        accepted = 0
+        rejected = []
+        with open(filename, "rb") as csvfile:
+            position = self.file_positions.get(filename)
+            if position is None:
+                csvfile.readline()
+                position = csvfile.tell()
+            csvfile.seek(position)
+            data = csvfile.read()
+
+        # Stop at the last complete line, the next one may be still
+        # being written
+        end = data.rfind(b'\n') + 1
+        try:
+            for line in data[:end].split(b'\n')[:-1]:
+                entry = line.decode().rstrip('\r')
+                fields = entry.count(',') + 1
+                try:
+                    if fields < ENTRY_FIELDS:
+                        rejected.append((entry, 'expected {} fields, found {}'.format(
+                            ENTRY_FIELDS, fields if entry else 0)))
+                    elif self.add_entry(entry):
+                        accepted += 1
+                except ValueError as exc:
+                    rejected.append((entry, str(exc)))
+                # Move on one line at a time, what has been applied is
+                # never read again
+                position += len(line) + 1
+        finally:
+            self.file_positions[filename] = position
+        return (accepted, rejected)
+
+def process_rolling_file(filename, window_days=30):
+    # Display the moving average and hot days at the end of every month,
+    # then the climatology of the whole file
+    analytics = RollingAnalytics(window_days)
+    month = None
+
+    with open(filename, "r") as csvfile:
+        header = csvfile.readline()
+        for entry in csvfile:
+            entry_without_newline = entry.rstrip('\n')
+            # Every entry is filtered and split once, then added directly
+            try:
+                if accept_entry(entry_without_newline):
+                    continue
+                record = entry_without_newline.split(',')
+                # Window at the end of the previous month, before this entry
+                previous = (analytics.moving_average(), analytics.hot_days())
+                analytics.add(int(record[2]), int(record[3]), int(record[4]),
+                              float(record[5]))
+            except ValueError as exc:
+                print('Skipped entry: ' + str(exc))
+                continue
+            if month is not None and month != (record[2], record[3]):
+                print('{}-{}: {}-day average = {:.2f}, 37+ days = {}'.format(
+                    month[0], month[1], window_days, previous[0], previous[1]))
+            month = (record[2], record[3])
+
+    if month is not None:
+        print('{}-{}: {}-day average = {:.2f}, 37+ days = {}'.format(
+            month[0], month[1], window_days,
+            analytics.moving_average(), analytics.hot_days()))
+
+    print()
+    for number, (average, hot) in enumerate(analytics.climatology()):
+        if average is not None:
+            print('{:<3s}: average = {:.2f}, number of 37+ days = {}'.format(
+                month_abbr[number + 1], average, hot))
+
+    return analytics
+
 if __name__ == "__main__":
     data_file_name = input("Enter file name: ")
     process_data_file(data_file_name)
@@ -4,8 +4,13 @@
     Then, on those calculate three distances:
     Euclidean, Manhattan and Cosine """
 
+from array import array
+import argparse
+import hashlib
+import heapq
 import math
-from statistics import mode
+import os
+import random
 import resource
 import time
 
@@ -56,25 +61,45 @@ def cosine(list_train, list_test):
 
     return distance
 
+def vote_all_k(label_list, k_values):
+    """Function to calculate the knn vote for several k at once, imput the
+    classes of the neighbours sorted closer to further and the k values.
+    Returns a dictionary k -> voted class. The neighbours are walked once,
+    keeping a running count per class, so all the k cost as the largest.
+    Ties go to the class met first, as statistics.mode does."""
+
+    wanted = set(k_values)
+    max_k = max(wanted)
+    if max_k > len(label_list):
+        raise ValueError("k = " + str(max_k) + " but only "
+                         + str(len(label_list)) + " neighbours")
+
+    counts = {}
+    first_seen = {}
+    best = None
+    votes = {}
+    for i in range(max_k):
+        label = label_list[i]
+        counts[label] = counts.get(label, 0) + 1
+        if label not in first_seen:
+            first_seen[label] = i
+        if best is None or counts[label] > counts[best] or \
+           (counts[label] == counts[best] and first_seen[label] < first_seen[best]):
+            best = label
+        if i + 1 in wanted:
+            votes[i + 1] = best
+
+    return votes
+
 def knn(mapped, test_class, k_val):
     """Function to calculate the knn, imput the sorted association distance/class
     the class of the test record and the value of k"""
-    
-    if k_val == 1:
-        # If k is 1 just return the first value
-        neighbor = (k_val,mapped[0][1],test_class)
-    
-    else:
-        # Otherwise pick the first k value in the mapped list
-        label_list = []
-        
-        for i in range(k_val):
-            label_list.append(mapped[i][1])
-            
-        # calculate the mode on the k value picked
-        train_class = mode(label_list)
-        
-        neighbor = (k_val,train_class,test_class)
+
+    # Pick the first k classes in the mapped list and take their vote
+    label_list = [item[1] for item in mapped[:k_val]]
+    train_class = vote_all_k(label_list, [k_val])[k_val]
+
+    neighbor = (k_val,train_class,test_class)
 
     return neighbor
  
@@ -82,8 +107,8 @@ def process_file(tr_file, te_file):
     """Function to process the files, open, read and then call the knn"""
 
     # Open the files
-    train_file = open(tr_file, "rU")
-    test_file = open(te_file, "rU")
+    train_file = open(tr_file, "r")
+    test_file = open(te_file, "r")
 
     # List to store the results
     eu_res = []
@@ -187,32 +212,456 @@ def process_file(tr_file, te_file):
 
         print(str(value) + ' | ' + str(c_true) + '/' + str(c_false))
 
+METRICS = {'Euclidean': euclidean, 'Manhattan': manhattan, 'Cosine': cosine}
+
+def load_records(filename):
+    """Function to read a dataset file in the process_file format, returns
+    the list of records (features as floats followed by the class, so the
+    distance functions can use them) and the list of classes"""
+
+    records = []
+    labels = []
+    with open(filename, "r") as data_file:
+        # Remove the header
+        data_file.readline()
+        for entry in data_file:
+            record = entry.rstrip('\n').split(',')
+            if record == ['']:
+                continue
+            label = int(record[-1])
+            records.append([float(value) for value in record[:-1]] + [label])
+            labels.append(label)
+
+    return records, labels
+
+def neighbour_orderings(train, train_labels, queries, metric, depth,
+                        leave_one_out=False, cache_dir=None, cache_key='',
+                        block_size=256, leave_out=None):
+    """Function to calculate, for each query record, the indexes of its
+    depth nearest train records sorted closer to further (ties broken by
+    class, like the sort in process_file). With leave_one_out the queries
+    are the train records and each one is left out of its own neighbours;
+    leave_out can instead give, per query, the train index to leave out
+    (not to be combined with cache_dir, the key does not include it).
+    The queries are processed in blocks of block_size and the orderings
+    are yielded one block (list of orderings) at a time, so only a block
+    is in memory. If cache_dir is given every block is stored there and
+    read back on the next run, also from orderings cached deeper."""
+
+    distance = METRICS[metric]
+    if cache_dir is not None:
+        # One directory per depth: cache_key-b<block size>-metric/d<depth>
+        metric_dir = os.path.join(cache_dir, '{}-b{}-{}'.format(cache_key, block_size, metric))
+        os.makedirs(metric_dir, exist_ok=True)
+        depths = sorted(int(name[1:]) for name in os.listdir(metric_dir)
+                        if name[:1] == 'd' and name[1:].isdigit() and int(name[1:]) >= depth)
+
+    for first in range(0, len(queries), block_size):
+        block = queries[first:first + block_size]
+
+        orderings = None
+        if cache_dir is not None:
+            for stored_depth in depths:
+                block_file = os.path.join(metric_dir, 'd' + str(stored_depth),
+                                          'block-{}.bin'.format(first))
+                if not os.path.exists(block_file):
+                    continue
+                stored = array('i')
+                with open(block_file, 'rb') as cached:
+                    stored.frombytes(cached.read())
+                if len(stored) == len(block) * stored_depth:
+                    orderings = [stored[row*stored_depth:row*stored_depth + depth].tolist()
+                                 for row in range(len(block))]
+                    break
+
+        if orderings is None:
+            orderings = []
+            stored = array('i')
+            for offset, query in enumerate(block):
+                dist_list = [distance(record, query) for record in train]
+                candidates = range(len(train))
+                left_out = first + offset if leave_one_out else None
+                if leave_out is not None:
+                    left_out = leave_out[first + offset]
+                if left_out is not None:
+                    candidates = [j for j in candidates if j != left_out]
+                order = heapq.nsmallest(depth, candidates,
+                                        key=lambda j: (dist_list[j], train_labels[j]))
+                orderings.append(order)
+                stored.extend(order)
+
+            if cache_dir is not None:
+                os.makedirs(os.path.join(metric_dir, 'd' + str(depth)), exist_ok=True)
+                block_file = os.path.join(metric_dir, 'd' + str(depth),
+                                          'block-{}.bin'.format(first))
+                with open(block_file, 'wb') as cached:
+                    cached.write(stored.tobytes())
+
+        yield orderings
+
+def _cache_key(tr_file, te_file):
+    """The cached orderings are valid as long as the content of the files
+    is the same"""
+    digest = hashlib.sha1()
+    for name in (tr_file, te_file):
+        if name is not None:
+            with open(name, 'rb') as data_file:
+                digest.update(data_file.read())
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+def evaluate(tr_file, te_file=None, k=(1, 3, 5, 9), metrics=None,
+             cache_dir=None, depth=None, block_size=256):
+    """Function to evaluate the knn for a set of k values and metrics,
+    computing the neighbour orderings once per metric. Without te_file
+    the evaluation is a leave-one-out cross-validation over the train
+    file. The orderings keep depth neighbours (the largest k by default);
+    a larger depth lets later runs evaluate any k up to it from the cache.
+    Every block of orderings is scored as soon as it is ready.
+    Returns a dictionary metric -> {k: (correct, wrong)}"""
+
+    if metrics is None:
+        metrics = list(METRICS)
+    k = sorted(set(k))
+    if not k or k[0] < 1:
+        raise ValueError("k must be at least 1, got " + str(k))
+
+    train, train_labels = load_records(tr_file)
+    leave_one_out = te_file is None
+    if leave_one_out:
+        queries, query_labels = train, train_labels
+    else:
+        queries, query_labels = load_records(te_file)
+
+    available = len(train) - 1 if leave_one_out else len(train)
+    depth = k[-1] if depth is None else max(min(depth, available), k[-1])
+    if k[-1] > available:
+        raise ValueError("k = " + str(k[-1]) + " but only "
+                         + str(available) + " neighbours")
+
+    cache_key = ''
+    if cache_dir is not None:
+        cache_key = _cache_key(tr_file, te_file)
+
+    results = {}
+    for metric in metrics:
+        table = dict((value, [0, 0]) for value in k)
+        query = 0
+        for block in neighbour_orderings(train, train_labels, queries, metric,
+                                         depth, leave_one_out, cache_dir,
+                                         cache_key, block_size):
+            for order in block:
+                votes = vote_all_k([train_labels[j] for j in order], k)
+                for value in k:
+                    if votes[value] == query_labels[query]:
+                        table[value][0] += 1
+                    else:
+                        table[value][1] += 1
+                query += 1
+        results[metric] = dict((value, tuple(table[value])) for value in k)
+
+    return results
+
+def print_evaluation(results):
+    """Function to print the results of evaluate in the same tables of
+    process_file"""
+
+    for i, metric in enumerate(results):
+        if i:
+            print()
+        print("k | " + metric + " correct/wrong")
+        for value, (c_true, c_false) in results[metric].items():
+            print(str(value) + ' | ' + str(c_true) + '/' + str(c_false))
+
+LSH_METRICS = ('Euclidean', 'Cosine')
+
+class LSHIndex:
+    """Approximate nearest neighbour index over the train records, with
+    random projection hashing. For Cosine every hash is the side of a
+    random hyperplane; for Euclidean it is a random projection cut in
+    buckets of the given width (estimated from the data if None).
+    Each of the tables concatenates hashes functions, and a query looks
+    in its bucket plus probes nearby buckets per table (the ones reached
+    changing the hash closest to its boundary). The candidates found are
+    then sorted with the exact distance."""
+
+    def __init__(self, records, labels, metric, tables=8, hashes=8, probes=2,
+                 width=None, seed=0):
+        if metric not in LSH_METRICS:
+            raise ValueError("No approximate search for " + metric)
+        self.records = records
+        self.labels = labels
+        self.metric = metric
+        self.distance = METRICS[metric]
+        self.probes = probes
+        self.fallbacks = 0
+
+        rng = random.Random(seed)
+        features = len(records[0]) - 1
+        self.planes = [[[rng.gauss(0, 1) for f in range(features)]
+                        for h in range(hashes)] for t in range(tables)]
+
+        if metric == 'Cosine':
+            # Records far from the origin sit in a narrow cone that random
+            # hyperplanes rarely cut: remove from the planes the mean
+            # direction, so that every hyperplane goes through the cone
+            mean = [sum(record[f] for record in records) / len(records)
+                    for f in range(features)]
+            norm = self._dot(mean, mean)
+            if norm > 0:
+                for table in self.planes:
+                    for plane in table:
+                        along = self._dot(plane, mean) / norm
+                        for f in range(features):
+                            plane[f] -= along * mean[f]
+
+        if metric == 'Euclidean':
+            if width is None:
+                # Bucket width as the spread of the projections
+                sample = rng.sample(records, min(len(records), 200))
+                spread = []
+                for plane in self.planes[0]:
+                    values = [self._dot(plane, record) for record in sample]
+                    mean = sum(values) / len(values)
+                    spread.append(math.sqrt(sum((v - mean)**2 for v in values) / len(values)))
+                width = max(sum(spread) / len(spread), 1e-12)
+            self.width = width
+            self.offsets = [[rng.uniform(0, width) for h in range(hashes)]
+                            for t in range(tables)]
+
+        self.buckets = [{} for t in range(tables)]
+        for index, record in enumerate(records):
+            for table in range(tables):
+                key = tuple(self._hash(table, record)[0])
+                self.buckets[table].setdefault(key, []).append(index)
+
+    @staticmethod
+    def _dot(plane, record):
+        total = 0.0
+        for i in range(len(plane)):
+            total += plane[i] * record[i]
+        return total
+
+    def _hash(self, table, record):
+        """Return the hash values of the record in one table, and for
+        each of them the distance to its boundary and the value on the
+        other side of it"""
+        values = []
+        margins = []
+        for h, plane in enumerate(self.planes[table]):
+            projection = self._dot(plane, record)
+            if self.metric == 'Cosine':
+                value = 1 if projection >= 0 else 0
+                margins.append((abs(projection), h, 1 - value))
+            else:
+                position = (projection + self.offsets[table][h]) / self.width
+                value = math.floor(position)
+                fraction = position - value
+                if fraction < 0.5:
+                    margins.append((fraction, h, value - 1))
+                else:
+                    margins.append((1 - fraction, h, value + 1))
+            values.append(value)
+        return values, margins
+
+    def candidates(self, record):
+        """Return the set of train indexes sharing a probed bucket with
+        the record"""
+        found = set()
+        for table in range(len(self.planes)):
+            values, margins = self._hash(table, record)
+            found.update(self.buckets[table].get(tuple(values), ()))
+            margins.sort()
+            for (margin, h, other) in margins[:self.probes]:
+                probe = list(values)
+                probe[h] = other
+                found.update(self.buckets[table].get(tuple(probe), ()))
+        return found
+
+    def query(self, record, depth, leave_out=None):
+        """Return the indexes of the depth nearest train records found,
+        sorted closer to further (ties broken by class), leaving out the
+        train index leave_out. If the buckets hold fewer than depth
+        candidates all the train set is scanned."""
+        found = self.candidates(record)
+        found.discard(leave_out)
+        if len(found) < depth:
+            self.fallbacks += 1
+            found = [j for j in range(len(self.records)) if j != leave_out]
+        dist = dict((j, self.distance(self.records[j], record)) for j in found)
+        return sorted(found, key=lambda j: (dist[j], self.labels[j]))[:depth]
+
+def evaluate_approximate(tr_file, te_file=None, k=(1, 3, 5, 9),
+                         metrics=('Euclidean', 'Cosine'), tables=8, hashes=8,
+                         probes=2, width=None, seed=0, recall_sample=0.1,
+                         cache_dir=None):
+    """Function to evaluate the knn with the approximate LSHIndex search,
+    with leave-one-out over the train file when te_file is not given.
+    Returns a dictionary metric -> {k: (correct, wrong, recall)}, recall
+    being the fraction of the exact k nearest neighbours that were found,
+    and a dictionary metric -> statistics of the search. The exact search
+    for the recall runs on a random fraction recall_sample of the queries
+    (all of them if 1, cached in cache_dir if given; none if 0, and the
+    recall is then None)."""
+
+    k = sorted(set(k))
+    if not k or k[0] < 1:
+        raise ValueError("k must be at least 1, got " + str(k))
+    for metric in metrics:
+        if metric not in LSH_METRICS:
+            raise ValueError("No approximate search for " + metric)
+
+    train, train_labels = load_records(tr_file)
+    leave_one_out = te_file is None
+    if leave_one_out:
+        queries, query_labels = train, train_labels
+    else:
+        queries, query_labels = load_records(te_file)
+    available = len(train) - 1 if leave_one_out else len(train)
+    if k[-1] > available:
+        raise ValueError("k = " + str(k[-1]) + " but only "
+                         + str(available) + " neighbours")
+
+    # Queries whose exact neighbours are computed for the recall
+    if recall_sample >= 1:
+        sample = list(range(len(queries)))
+    else:
+        size = int(round(len(queries) * recall_sample))
+        if recall_sample > 0:
+            size = max(size, 1)
+        sample = sorted(random.Random(seed).sample(range(len(queries)), size))
+        cache_dir = None
+    cache_key = ''
+    if cache_dir is not None:
+        cache_key = _cache_key(tr_file, te_file)
+
+    results = {}
+    statistics = {}
+    for metric in metrics:
+        start = time.perf_counter()
+        index = LSHIndex(train, train_labels, metric, tables, hashes, probes,
+                         width, seed)
+        built = time.perf_counter()
+        orderings = [index.query(query, k[-1], i if leave_one_out else None)
+                     for i, query in enumerate(queries)]
+        searched = time.perf_counter()
+
+        table = dict((value, [0, 0, 0.0]) for value in k)
+        for order, test_label in zip(orderings, query_labels):
+            votes = vote_all_k([train_labels[j] for j in order], k)
+            for value in k:
+                if votes[value] == test_label:
+                    table[value][0] += 1
+                else:
+                    table[value][1] += 1
+
+        # Exact orderings only as deep as the largest k, block by block
+        sampled = 0
+        if sample:
+            leave_out = sample if leave_one_out and len(sample) < len(queries) else None
+            blocks = neighbour_orderings(
+                train, train_labels, [queries[i] for i in sample], metric, k[-1],
+                leave_one_out and leave_out is None, cache_dir, cache_key,
+                leave_out=leave_out)
+            for block in blocks:
+                for exact_order in block:
+                    order = orderings[sample[sampled]]
+                    for value in k:
+                        found = set(order[:value])
+                        table[value][2] += sum(1 for j in exact_order[:value] if j in found) / value
+                    sampled += 1
+
+        results[metric] = dict((value, (table[value][0], table[value][1],
+                                        table[value][2] / sampled if sampled else None))
+                               for value in k)
+        statistics[metric] = {'build_time': built - start,
+                              'search_time': searched - built,
+                              'fallbacks': index.fallbacks,
+                              'recall_queries': sampled}
+
+    return results, statistics
+
+def print_approximate(results, statistics):
+    """Function to print the results of evaluate_approximate, the tables
+    of process_file with the recall of each k"""
+
+    for i, metric in enumerate(results):
+        if i:
+            print()
+        print("k | " + metric + " correct/wrong | recall")
+        for value, (c_true, c_false, recall) in results[metric].items():
+            print(str(value) + ' | ' + str(c_true) + '/' + str(c_false)
+                  + ' | ' + ('-' if recall is None else '{:.3f}'.format(recall)))
+        print('search {:.3f}s, index {:.3f}s, {} exact fallbacks, recall on {} queries'.format(
+            statistics[metric]['search_time'], statistics[metric]['build_time'],
+            statistics[metric]['fallbacks'], statistics[metric]['recall_queries']))
+
 # MAIN
-# Define the files to use
-bc_train = 'breast-cancer-train.csv'
-bc_test = 'breast-cancer-test-assignment.csv'
-ir_train = 'iris-train.csv'
-ir_test = 'iris-test-assignment.csv'
-
-# Call the process_file on the defined files
-print("Breast Cancer Dataset\n")
-process_file(bc_train, bc_test)
-print('\n---------------\n')
-print("Iris Dataset\n")
-process_file(ir_train, ir_test)
-
-# Routine to retrieve the program statistics
-# using standard resource library and its man suggested use
-usage = resource.getrusage(resource.RUSAGE_SELF)
-print('\n----- Module Statistics-----\n')
-for name, desc in [
-    ('ru_utime', 'User time'),
-    ('ru_stime', 'System time'),
-    ('ru_maxrss', 'Max. Resident Set Size'),
-    ('ru_ixrss', 'Shared Memory Size'),
-    ('ru_idrss', 'Unshared Memory Size'),
-    ('ru_isrss', 'Stack Size'),
-    ('ru_inblock', 'Block inputs'),
-    ('ru_oublock', 'Block outputs'),
-    ]:
-    print('%-25s (%-10s) = %s' % (desc, name, getattr(usage, name)))
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Evaluate the knn on a train file and a test file, "
+                    "or with leave-one-out when no test file is given.")
+    parser.add_argument('train', nargs='?')
+    parser.add_argument('test', nargs='?')
+    parser.add_argument('-k', type=int, nargs='+', default=[1, 3, 5, 9])
+    parser.add_argument('--metric', choices=list(METRICS), nargs='+')
+    parser.add_argument('--cache-dir',
+                        help="store the neighbour orderings in this directory")
+    parser.add_argument('--depth', type=int,
+                        help="neighbours kept per record (default: the largest k)")
+    parser.add_argument('--approximate', action='store_true',
+                        help="use the LSH search (Euclidean and Cosine only)")
+    parser.add_argument('--tables', type=int, default=8)
+    parser.add_argument('--hashes', type=int, default=8,
+                        help="hash functions per LSH table")
+    parser.add_argument('--probes', type=int, default=2,
+                        help="extra buckets probed per LSH table")
+    parser.add_argument('--recall-sample', type=float, default=0.1,
+                        help="fraction of the queries used to measure the recall "
+                             "of the LSH search against the exact one, 0 to skip it")
+    args = parser.parse_args()
+
+    if min(args.k) < 1:
+        parser.error("-k values must be at least 1")
+    if args.approximate:
+        if not args.train:
+            parser.error("--approximate needs a train file")
+        if args.metric and set(args.metric) - set(LSH_METRICS):
+            parser.error("--approximate supports only the metrics "
+                         + ', '.join(LSH_METRICS))
+        print_approximate(*evaluate_approximate(
+            args.train, args.test, args.k, args.metric or LSH_METRICS,
+            args.tables, args.hashes, args.probes,
+            recall_sample=args.recall_sample, cache_dir=args.cache_dir))
+    elif args.train:
+        print_evaluation(evaluate(args.train, args.test, args.k, args.metric,
+                                  args.cache_dir, args.depth))
+    else:
+        # Define the files to use
+        bc_train = 'breast-cancer-train.csv'
+        bc_test = 'breast-cancer-test-assignment.csv'
+        ir_train = 'iris-train.csv'
+        ir_test = 'iris-test-assignment.csv'
+
+        # Call the process_file on the defined files
+        print("Breast Cancer Dataset\n")
+        process_file(bc_train, bc_test)
+        print('\n---------------\n')
+        print("Iris Dataset\n")
+        process_file(ir_train, ir_test)
+
+        # Routine to retrieve the program statistics
+        # using standard resource library and its man suggested use
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        print('\n----- Module Statistics-----\n')
+        for name, desc in [
+            ('ru_utime', 'User time'),
+            ('ru_stime', 'System time'),
+            ('ru_maxrss', 'Max. Resident Set Size'),
+            ('ru_ixrss', 'Shared Memory Size'),
+            ('ru_idrss', 'Unshared Memory Size'),
+            ('ru_isrss', 'Stack Size'),
+            ('ru_inblock', 'Block inputs'),
+            ('ru_oublock', 'Block outputs'),
+            ]:
+            print('%-25s (%-10s) = %s' % (desc, name, getattr(usage, name)))
@@ -2,6 +2,15 @@
 #
 # Graph algorithms implementation: including DFS
 
+import heapq
+import math
+import os
+import sys
+from array import array
+from collections import deque
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
 def read_graph_from_file(filename):
     '''This function reads a graph from a file and returns a tuple of
     two lists: (neighbours, positions): neighbours is the neighbour
@@ -14,7 +23,7 @@ def read_graph_from_file(filename):
     node = 0
     link_found = False
 
-    csvfile = open(filename, 'rU')
+    csvfile = open(filename, 'r')
     # Read the file, keep track of the line in the file at the same time,
     # used for the error handling
 
@@ -85,6 +94,147 @@ def read_graph_from_file(filename):
 
     return (neighbour_list,position_list)
 
+# Parallel loading of large graph files
+def _find_chunks(filename, chunks):
+    '''Split the file in about chunks byte ranges (start, end), every
+    range ending just after a newline.'''
+    size = os.path.getsize(filename)
+    bounds = [0]
+    with open(filename, 'rb') as graph_file:
+        for i in range(1, chunks):
+            position = max(size * i // chunks, bounds[-1])
+            graph_file.seek(position)
+            graph_file.readline()
+            position = graph_file.tell()
+            if position >= size:
+                break
+            if position > bounds[-1]:
+                bounds.append(position)
+    bounds.append(size)
+    return [(bounds[i], bounds[i + 1]) for i in range(len(bounds) - 1)]
+
+def _parse_graph_chunk(task):
+    '''Parse the lines in one byte range of a graph file. Returns a
+    tuple (lines, nodes, links, segments, error): lines is the number of
+    lines in the range; nodes is (ids, xs, ys) and links is (a, b), as
+    integer arrays; segments lists [kind, first line, count] for each run
+    of consecutive node or link lines, so that the line of every record
+    can be found again; error is (line, message) if a line could not be
+    parsed. Line numbers are relative to the start of the range.'''
+    (filename, start, end) = task
+    with open(filename, 'rb') as graph_file:
+        graph_file.seek(start)
+        data = graph_file.read(end - start)
+
+    lines = data.split(b'\n')
+    if data.endswith(b'\n'):
+        lines.pop()
+
+    node_ids = array('q')
+    xs = array('q')
+    ys = array('q')
+    link_a = array('q')
+    link_b = array('q')
+    segments = []
+    error = None
+
+    for line, entry in enumerate(lines):
+        record = entry.rstrip(b'\r').split(b',')
+        try:
+            if len(record) == 3:
+                kind = 'node'
+                (node, x, y) = (int(record[0]), int(record[1]), int(record[2]))
+                node_ids.append(node)
+                xs.append(x)
+                ys.append(y)
+            elif len(record) == 2:
+                kind = 'link'
+                (a, b) = (int(record[0]), int(record[1]))
+                link_a.append(a)
+                link_b.append(b)
+            else:
+                continue
+        except (ValueError, OverflowError):
+            error = (line, 'Values are not integer!')
+            break
+
+        if segments and segments[-1][0] == kind and \
+           segments[-1][1] + segments[-1][2] == line:
+            segments[-1][2] += 1
+        else:
+            segments.append([kind, line, 1])
+
+    return (len(lines), (node_ids, xs, ys), (link_a, link_b), segments, error)
+
+def read_graph_from_file_parallel(filename, workers=None, chunk_bytes=1<<22):
+    '''This function reads a graph from a file like read_graph_from_file
+    and returns the same (neighbours, positions) tuple, but the file is
+    split in byte ranges of about chunk_bytes, on line boundaries, that
+    are parsed by workers processes (default: one per CPU). The file is
+    then validated in order, so errors carry the same line numbers.'''
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    chunks = max(1, min(os.path.getsize(filename) // chunk_bytes + 1, 64*workers))
+    tasks = [(filename, start, end) for (start, end) in _find_chunks(filename, chunks)]
+
+    if workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_parse_graph_chunk, tasks))
+    else:
+        results = [_parse_graph_chunk(task) for task in tasks]
+
+    # Validate the records in file order, one run of lines at a time,
+    # raising the first error the sequential reader would meet
+    node_count = 0
+    link_found = False
+    line_offset = 0
+    for (lines, (node_ids, xs, ys), (link_a, link_b), segments, error) in results:
+        node_index = 0
+        link_index = 0
+        for (kind, first, count) in segments:
+            line = line_offset + first
+            if kind == 'node':
+                ids = node_ids[node_index:node_index + count]
+                if link_found:
+                    if ids[0] != node_count:
+                        raise FileFormatError(filename, line, 'Nodes are not ordered!')
+                    raise FileFormatError(filename, line, 'Nodes and link are not in the correct sequence!')
+                if ids != array('q', range(node_count, node_count + count)):
+                    for i, node in enumerate(ids):
+                        if node != node_count + i:
+                            raise FileFormatError(filename, line + i, 'Nodes are not ordered!')
+                node_count += count
+                node_index += count
+            else:
+                link_found = True
+                a = link_a[link_index:link_index + count]
+                b = link_b[link_index:link_index + count]
+                if max(max(a), max(b)) > node_count - 1 or min(min(a), min(b)) < 0:
+                    for i in range(count):
+                        if not (0 <= a[i] < node_count and 0 <= b[i] < node_count):
+                            raise FileFormatError(filename, line + i, 'Link Involves Nodes Out Of Range!')
+                link_index += count
+        if error is not None:
+            raise FileFormatError(filename, line_offset + error[0], error[1])
+        line_offset += lines
+
+    position_list = []
+    for (lines, (node_ids, xs, ys), links, segments, error) in results:
+        position_list.extend(zip(xs, ys))
+
+    # Each link is stored in both directions, neighbours sorted like
+    # read_graph_from_file does
+    neighbour_list = [[] for node in range(node_count)]
+    for (lines, nodes, (link_a, link_b), segments, error) in results:
+        for (a, b) in zip(link_a, link_b):
+            neighbour_list[a].append(b)
+            neighbour_list[b].append(a)
+    for element_list in neighbour_list:
+        element_list.sort()
+
+    return (neighbour_list, position_list)
+
 ## Implementing this function is task 2:
 def label_graph_components(neighbour_list):
     '''This function takes as input the neighbour list representation of
@@ -92,43 +242,28 @@ def label_graph_components(neighbour_list):
     the graph. Components must be numbered consecutively, starting from
     zero.'''
 
-    # Labelled list initialised at -1
+    # Labelled list initialised at -1, a node still at -1 is not visited
     label_list = [-1]*len(neighbour_list)
-
-    # Define a set for visited nodes
-    visited = set()
     # Define first label that is 0
     label = 0
 
     # Walk the graph with Depth-First Search
-    # The label is passed as parameter and managed to maintain the consecutive increment of the label itself.
-    # For this reason, chose to return the label value from/to the recursive call.
-
-    def node_labelling(n,l):
-        # Ignore visited nodes
-        if n in visited:
-            # return the label itself and do nothing else
-            return l
-        else:
-            # Add the node to the visited
-            visited.add(n)
-            # Check if already labelled, and label it
-            if label_list[n] == -1:
-                label_list[n] = l
-
-            # Recursive call on the neighbour nodes
-            for neighbour in neighbour_list[n]: 
-                node_labelling(neighbour,l)
-            # Increment label for a new graph component, return it
-            l += 1
-            return l
-
-    # Main call of the function, passing the grph and the label
-    for node,item in enumerate(neighbour_list):
-        label = node_labelling(node,label)
-
-    # print("visited:",visited)
-    # print("label list:",label_list)
+    # An explicit stack is used instead of recursion, so that components
+    # larger than the recursion limit can be labelled.
+    # Every node not yet visited starts a new component, the label is then
+    # incremented to keep them consecutive.
+    for node in range(len(neighbour_list)):
+        if label_list[node] != -1:
+            continue
+        label_list[node] = label
+        stack = [node]
+        while stack:
+            n = stack.pop()
+            for neighbour in neighbour_list[n]:
+                if label_list[neighbour] == -1:
+                    label_list[neighbour] = label
+                    stack.append(neighbour)
+        label += 1
 
     return label_list
 
@@ -210,6 +345,199 @@ def component_is_a_tree(label, neighbour_list, label_list):
     else:
         return False
 
+# Shortest path analysis
+def bfs_shortest_paths(source, neighbour_list):
+    '''This function takes a source node and the neighbour list
+    representation of a graph, and walks the graph with Breadth-First
+    Search. It returns a tuple of two lists: (distances, parents):
+    distances gives the number of hops from the source to each node,
+    None if the node cannot be reached; parents gives the previous node
+    on a shortest path, None for the source and for unreachable nodes.'''
+
+    if source < 0 or source >= len(neighbour_list):
+        raise ValueError("Source node " + str(source) + " out of range!")
+
+    distance_list = [None]*len(neighbour_list)
+    parent_list = [None]*len(neighbour_list)
+    distance_list[source] = 0
+
+    # The queue makes sure nodes are reached in hop order, so the first
+    # time a node is seen is also its shortest distance
+    queue = deque([source])
+    while queue:
+        node = queue.popleft()
+        for neighbour in neighbour_list[node]:
+            if distance_list[neighbour] is None:
+                distance_list[neighbour] = distance_list[node] + 1
+                parent_list[neighbour] = node
+                queue.append(neighbour)
+
+    return (distance_list, parent_list)
+
+def dijkstra_shortest_paths(source, neighbour_list, position_list):
+    '''This function takes a source node, the neighbour list
+    representation of a graph and the list of node positions, and
+    computes the shortest paths with Dijkstra. The length of every link
+    is the Euclidean distance between the positions of its two nodes.
+    It returns a tuple of two lists (distances, parents) like
+    bfs_shortest_paths.'''
+
+    if source < 0 or source >= len(neighbour_list):
+        raise ValueError("Source node " + str(source) + " out of range!")
+
+    distance_list = [None]*len(neighbour_list)
+    parent_list = [None]*len(neighbour_list)
+    distance_list[source] = 0.0
+
+    # Heap of (distance, node), stale entries are skipped when popped
+    heap = [(0.0, source)]
+    done = set()
+    while heap:
+        (dist, node) = heapq.heappop(heap)
+        if node in done:
+            continue
+        done.add(node)
+        (xn, yn) = position_list[node]
+        for neighbour in neighbour_list[node]:
+            if neighbour in done:
+                continue
+            (xm, ym) = position_list[neighbour]
+            new_dist = dist + math.hypot(xm - xn, ym - yn)
+            if distance_list[neighbour] is None or new_dist < distance_list[neighbour]:
+                distance_list[neighbour] = new_dist
+                parent_list[neighbour] = node
+                heapq.heappush(heap, (new_dist, neighbour))
+
+    return (distance_list, parent_list)
+
+def get_path(target, distance_list, parent_list):
+    '''This function rebuilds the path from the source of a shortest
+    path tree (distances, parents) to the target node. It returns the
+    list of nodes from source to target, or None if the target cannot
+    be reached. Missing values are None, as bfs_shortest_paths returns
+    them, or -1, as ShortestPathCache stores them.'''
+
+    if distance_list[target] is None or distance_list[target] < 0:
+        return None
+
+    path = [target]
+    while parent_list[path[-1]] is not None and parent_list[path[-1]] >= 0:
+        path.append(parent_list[path[-1]])
+    path.reverse()
+
+    return path
+
+class ShortestPathCache:
+    '''Answers shortest path queries on one graph, keeping the shortest
+    path trees of the most recently used sources in an LRU cache.
+    The cache is bounded by max_bytes, an estimate of the memory used by
+    the stored trees. If label_list is given (see label_graph_components)
+    queries between nodes in different components are answered without
+    walking the graph. position_list is needed only for weighted queries.'''
+
+    def __init__(self, neighbour_list, position_list=None, label_list=None,
+                 max_bytes=64*1024*1024):
+        self.neighbour_list = neighbour_list
+        self.position_list = position_list
+        if label_list is None:
+            label_list = label_graph_components(neighbour_list)
+        self.label_list = label_list
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        # (source, weighted) -> (distances, parents, size), the trees are
+        # stored in typed arrays with -1 for unreachable nodes and the source
+        # parent, so that their size is known exactly
+        self._trees = OrderedDict()
+
+    def _tree(self, source, weighted, store=True):
+        # With store False a missing tree is computed but not cached, and
+        # a cached one keeps its place in the LRU order
+        key = (source, weighted)
+        if key in self._trees:
+            self.hits += 1
+            if store:
+                self._trees.move_to_end(key)
+            return self._trees[key]
+
+        self.misses += 1
+        if weighted:
+            if self.position_list is None:
+                raise ValueError("Weighted queries need the position list!")
+            (distance_list, parent_list) = dijkstra_shortest_paths(
+                source, self.neighbour_list, self.position_list)
+        else:
+            (distance_list, parent_list) = bfs_shortest_paths(
+                source, self.neighbour_list)
+
+        distances = array('d' if weighted else 'q',
+                          [-1 if dist is None else dist for dist in distance_list])
+        parents = array('q', [-1 if parent is None else parent for parent in parent_list])
+        size = sys.getsizeof(distances) + sys.getsizeof(parents)
+        tree = (distances, parents, size)
+
+        # Trees larger than the whole budget are returned but not stored
+        if store and size <= self.max_bytes:
+            while self.used_bytes + size > self.max_bytes:
+                (old_key, old_tree) = self._trees.popitem(last=False)
+                self.used_bytes -= old_tree[2]
+            self._trees[key] = tree
+            self.used_bytes += size
+
+        return tree
+
+    def _reachable(self, source, target):
+        for node in (source, target):
+            if node < 0 or node >= len(self.neighbour_list):
+                raise ValueError("Node " + str(node) + " out of range!")
+        return self.label_list[source] == self.label_list[target]
+
+    def distance(self, source, target, weighted=False):
+        '''Return the hop count (or the Euclidean length if weighted)
+        of a shortest path from source to target, None if unreachable.'''
+        if not self._reachable(source, target):
+            return None
+        distance = self._tree(source, weighted)[0][target]
+        return None if distance < 0 else distance
+
+    def path(self, source, target, weighted=False):
+        '''Return the list of nodes on a shortest path from source to
+        target, None if unreachable.'''
+        if not self._reachable(source, target):
+            return None
+        (distances, parents, size) = self._tree(source, weighted)
+        return get_path(target, distances, parents)
+
+    def all_pairs(self, weighted=False):
+        '''Return the matrix (list of lists) of the shortest distances
+        between all pairs of nodes, None for unreachable pairs. The trees
+        are not stored, so the cached ones of the hot sources stay.'''
+
+        # Only the nodes in the component of the source are reachable
+        members = {}
+        for node, label in enumerate(self.label_list):
+            members.setdefault(label, []).append(node)
+
+        matrix = []
+        for source in range(len(self.neighbour_list)):
+            row = [None]*len(self.neighbour_list)
+            component = members[self.label_list[source]]
+            if len(component) == 1:
+                row[source] = 0.0 if weighted else 0
+            else:
+                distances = self._tree(source, weighted, store=False)[0]
+                for node in component:
+                    row[node] = distances[node]
+            matrix.append(row)
+
+        return matrix
+
+    def clear(self):
+        '''Empty the cache.'''
+        self._trees.clear()
+        self.used_bytes = 0
+
 class FileFormatError (Exception):
     def __init__(self, filename, line_num, message):
         super(Exception, self).__init__()
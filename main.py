@@ -1,42 +1,182 @@
+import argparse
+import csv
+import json
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 from graphAlgorithm import read_graph_from_file
+from graphAlgorithm import read_graph_from_file_parallel
 from graphAlgorithm import label_graph_components
-from graphAlgorithm import get_component_density
-from graphAlgorithm import component_is_a_tree
 from graphAlgorithm import FileFormatError
-from drawing import show_graph
 
-# ask user for a file name
-graph_file_name = input("Enter graph file name: ")
+# drawing imports tkinter, so it is only imported when a graph is shown
 
-try:
-    # read a graph from this file
-    (g_link_list, g_position_list) = read_graph_from_file(graph_file_name)
+CSV_FIELDS = ['file', 'component', 'nodes', 'density', 'is_tree',
+              'load_time', 'label_time', 'stats_time', 'error']
 
-    # display the graph
-    show_graph(g_link_list, g_position_list, title_str="Input graph")
+def count_component_nodes_links(neighbour_list, label_list):
+    '''This function counts the nodes and the links of every component in
+    one pass over the graph, and returns the two lists (nodes, links)
+    indexed by label. Links are counted as get_component_density and
+    component_is_a_tree do: a repeated link counts once, and so does a
+    link from a node to itself.'''
 
-    # calculate connected components
-    g_label_list = label_graph_components(g_link_list)
+    components = max(label_list) + 1 if label_list else 0
+    node_counts = [0]*components
+    # Every link is seen from both ends, a link to itself only once
+    link_ends = [0]*components
+    for node, label in enumerate(label_list):
+        node_counts[label] += 1
+        neighbours = set(neighbour_list[node])
+        link_ends[label] += len(neighbours) + (node in neighbours)
+    link_counts = [ends // 2 for ends in link_ends]
+
+    return (node_counts, link_counts)
+
+def analyse_graph_file(graph_file_name, parse_workers=1):
+    '''This function runs loading, labelling and per-component statistics
+    on one graph file without any interaction. It returns a dictionary
+    with the results and the time (in seconds) spent in every stage; if
+    the file cannot be processed the error is reported in the dictionary.
+    With parse_workers > 1 the file is parsed in chunks by that many
+    processes.'''
+
+    result = {'file': graph_file_name, 'components': [], 'timings': {},
+              'error': None}
+    try:
+        start = time.perf_counter()
+        if parse_workers > 1:
+            (g_link_list, g_position_list) = \
+                read_graph_from_file_parallel(graph_file_name, parse_workers)
+        else:
+            (g_link_list, g_position_list) = read_graph_from_file(graph_file_name)
+        result['timings']['load'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        g_label_list = label_graph_components(g_link_list)
+        result['timings']['label'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        (node_counts, link_counts) = count_component_nodes_links(g_link_list, g_label_list)
+        for label in range(len(node_counts)):
+            result['components'].append({
+                'component': label,
+                'nodes': node_counts[label],
+                'density': link_counts[label] / node_counts[label],
+                'is_tree': link_counts[label] <= node_counts[label] - 1})
+        result['timings']['stats'] = time.perf_counter() - start
+
+    except FileFormatError as ffe:
+        result['error'] = "Invalid graph file: " + str(ffe)
+
+    except Exception as exc:
+        result['error'] = "An error occurred: " + str(exc)
+
+    return result
+
+def write_json(results, out):
+    json.dump(results, out, indent=2)
+    out.write('\n')
 
-    # display graph with components
+def write_csv(results, out):
+    '''One row per component, a file that failed gets a single row
+    carrying the error.'''
+    writer = csv.DictWriter(out, fieldnames=CSV_FIELDS)
+    writer.writeheader()
+    for result in results:
+        timings = {'load_time': result['timings'].get('load'),
+                   'label_time': result['timings'].get('label'),
+                   'stats_time': result['timings'].get('stats')}
+        if result['error'] is not None or not result['components']:
+            writer.writerow(dict(timings, file=result['file'],
+                                 error=result['error']))
+        for component in result['components']:
+            writer.writerow(dict(component, file=result['file'], **timings))
+
+def show_graph_file(graph_file_name):
+    '''Display the input and the labelled graph, as the interactive
+    version always did.'''
+    from drawing import show_graph
+
+    (g_link_list, g_position_list) = read_graph_from_file(graph_file_name)
+    show_graph(g_link_list, g_position_list, title_str="Input graph")
+    g_label_list = label_graph_components(g_link_list)
     show_graph(g_link_list, g_position_list,
                title_str="Labelled graph", label_list=g_label_list)
 
-    # calculate and print density for each component in the graph
-    for label in range(max(g_label_list) + 1):
-        density = get_component_density(label, g_link_list, g_label_list)
-        print("density in component {} is {:.2f}".format(label, density))
+def print_results(result, out=sys.stdout):
+    '''Print the results of one file in the interactive format.'''
+    if result['error'] is not None:
+        print(result['error'], file=out)
+        return
+
+    # print density for each component in the graph
+    for component in result['components']:
+        print("density in component {} is {:.2f}".format(
+            component['component'], component['density']), file=out)
+
+    # print if each component in the graph is a tree
+    for component in result['components']:
+        if component['is_tree']:
+            print("Component {} is a tree".format(component['component']),
+                  file=out)
+        else:
+            print("Component {} is NOT a tree".format(component['component']),
+                  file=out)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Label graph components and compute their statistics.")
+    parser.add_argument('files', nargs='*',
+                        help="graph files, asked interactively if none is given")
+    parser.add_argument('--format', choices=['text', 'json', 'csv'],
+                        default='text', help="output format (default: text)")
+    parser.add_argument('--show', action='store_true',
+                        help="display the graphs (needs tkinter)")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="number of files processed concurrently")
+    parser.add_argument('--parse-workers', type=int, default=1,
+                        help="processes parsing each file in chunks")
+    parser.add_argument('-o', '--output',
+                        help="write the results to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    # Without arguments behave as the original interactive program
+    if not args.files:
+        args.files = [input("Enter graph file name: ")]
+        args.show = True
+
+    if args.jobs > 1 and len(args.files) > 1:
+        with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            results = list(executor.map(analyse_graph_file, args.files,
+                                        [args.parse_workers]*len(args.files)))
+    else:
+        results = [analyse_graph_file(name, args.parse_workers)
+                   for name in args.files]
+
+    if args.show:
+        for result in results:
+            if result['error'] is None:
+                show_graph_file(result['file'])
 
-    # calculate and print density for each component in the graph
-    for label in range(max(g_label_list) + 1):
-        if component_is_a_tree(label,g_link_list,g_label_list):
-            print("Component {} is a tree".format(label))
+    out = open(args.output, 'w', newline='') if args.output else sys.stdout
+    try:
+        if args.format == 'json':
+            write_json(results, out)
+        elif args.format == 'csv':
+            write_csv(results, out)
         else:
-            print("Component {} is NOT a tree".format(label))
+            for result in results:
+                if len(results) > 1:
+                    print("== " + result['file'], file=out)
+                print_results(result, out)
+    finally:
+        if out is not sys.stdout:
+            out.close()
 
-except FileFormatError as ffe:
-    print("Invalid graph file: " + str(ffe))
+    # Non-zero exit status if any file failed, useful when run from cron
+    return 1 if any(result['error'] for result in results) else 0
 
-except Exception as exc:
-    print("An error occurred: " + str(exc))
+if __name__ == "__main__":
+    sys.exit(main())